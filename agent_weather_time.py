@@ -1,22 +1,35 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import os
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Optional
+import time
+from datetime import date, datetime, timedelta, tzinfo
+from typing import Any, AsyncIterator, Optional, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
+import msgspec
 from dotenv import load_dotenv
 from langchain.chat_models import init_chat_model
-from langchain.tools import tool, ToolRuntime
+from langchain.tools import BaseTool, tool, ToolRuntime
 from langchain.agents import create_agent
-from langchain.agents.structured_output import ToolStrategy
+from langchain.agents.middleware import AgentMiddleware, ModelRequest, ModelResponse
+from langchain.messages import AIMessage
+from langchain.agents.structured_output import ProviderStrategy, StructuredOutputValidationError
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.utils.json import parse_partial_json
 from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 
+from llm_cache import LLMCache, cache_key
+from http_client import CircuitBreakerError, aclose, aprewarm
 from weather_app import (
-    get_weather_by_city,
+    aget_coordinates,
+    aget_weather_by_city,
+    aget_daily_forecast_by_city,
+    city_cache_key,
     get_coordinates,
-    get_hourly_weather,
-    get_daily_forecast_by_city,
+    is_error,
 )
 
 # загружаем переменные из .env (OPENAI_API_KEY, OPENAI_MODEL, PROXY_BASE_URL)
@@ -49,27 +62,85 @@ SYSTEM_PROMPT = """
   get_user_location для определения города по контексту.
 - Для получения информации о текущей погоде по городу используй tool
   get_weather_for_location.
+- Если нужна текущая погода в нескольких городах (например, сравнение),
+  используй один вызов get_weather_for_locations со списком городов.
 - Для получения прогноза на будущее (например, «завтра») используй tool
   get_forecast_for_location.
 - Для определения текущего времени используй tool get_current_time.
+- Если tools не зависят друг от друга (например, погода и текущее время),
+  вызывай их одновременно в одном шаге, а не по очереди.
+- Если tool сообщает, что сервис погоды временно недоступен, не вызывай
+  погодные tools повторно: ответь, что данные о погоде сейчас недоступны.
 - Соблюдай формат AssistantResponse даже если часть полей пустая (None).
 """
 
 
-# =========================
-# CONTEXT SCHEMA (dataclass)
-# =========================
+# ===============================
+# CONTEXT SCHEMA (msgspec.Struct)
+# ===============================
 
 
-@dataclass
-class AgentContext:
-    """Контекст выполнения агента, доступный внутри tools через ToolRuntime."""
+class AgentContext(msgspec.Struct, frozen=True, gc=False):
+    """
+    Контекст выполнения агента, доступный внутри tools через ToolRuntime.
+
+    Конструктор не валидирует поля и не ходит в сеть: контекст собирается
+    доверенным кодом через create() (в async-коде — acreate(), чтобы
+    геокодинг не блокировал event loop). Недоверенные данные (будущий REST API)
+    проверяются один раз на границе в from_json(), дальше по агенту
+    передаётся уже готовый объект.
+    """
 
     user_id: str
     user_name: str = "Пользователь"
     # Добавляем страну, чтобы уменьшить риск перепутать город
     default_city: str = "Иркутск,ru"
     default_timezone: str = "Europe/Moscow"
+    # Координаты default_city: геокодируются один раз при создании контекста,
+    # чтобы погодные tools не делали лишний запрос к geo API
+    default_coords: Optional[tuple[float, float]] = None
+
+    @classmethod
+    def create(cls, **fields: Any) -> "AgentContext":
+        """Собрать контекст из доверенного кода (без валидации) и геокодировать default_city."""
+        return cls(**fields)._with_default_coords()
+
+    @classmethod
+    async def acreate(cls, **fields: Any) -> "AgentContext":
+        """Асинхронный create(): геокодинг через aget_coordinates, без блокировки event loop."""
+        return await cls(**fields)._awith_default_coords()
+
+    @classmethod
+    def from_json(cls, payload: Union[bytes, str]) -> "AgentContext":
+        """Разобрать и провалидировать контекст из недоверенного JSON — один раз, на границе."""
+        return msgspec.json.decode(payload, type=cls)._with_default_coords()
+
+    def _with_default_coords(self) -> "AgentContext":
+        if self.default_coords is not None:
+            return self
+        try:
+            coords = get_coordinates(self.default_city)
+        except CircuitBreakerError:
+            # Сервис погоды недоступен: tools геокодируют город позже сами
+            return self
+        return msgspec.structs.replace(self, default_coords=coords)
+
+    async def _awith_default_coords(self) -> "AgentContext":
+        if self.default_coords is not None:
+            return self
+        try:
+            coords = await aget_coordinates(self.default_city)
+        except Exception:
+            # Координаты — только оптимизация: при любом сбое геокодинга
+            # (breaker, сеть, event loop) tools геокодируют город позже сами
+            return self
+        return msgspec.structs.replace(self, default_coords=coords)
+
+    def coords_for(self, city: str) -> Optional[tuple[float, float]]:
+        """Вернуть известные координаты, если city — это город по умолчанию."""
+        if city_cache_key(city) == city_cache_key(self.default_city):
+            return self.default_coords
+        return None
 
 
 # ==================================
@@ -77,8 +148,10 @@ class AgentContext:
 # ==================================
 
 
-@dataclass
-class AssistantResponse:
+# msgspec.Struct уже хранит поля в слотах (без __dict__). Поля ответа — только
+# строки, числа и None, циклов ссылок быть не может, поэтому gc=False убирает
+# GC-заголовок у каждого ответа, который копится в состоянии checkpointer.
+class AssistantResponse(msgspec.Struct, frozen=True, gc=False):
     """Структурированный ответ агента."""
 
     intent: str
@@ -90,36 +163,53 @@ class AssistantResponse:
     reasoning: str = ""
 
 
+def _strict_schema(schema: dict) -> dict:
+    """
+    Привести JSON-схему объекта к требованиям strict-режима OpenAI.
+
+    В strict-режиме все свойства должны быть перечислены в required,
+    additionalProperties запрещены, а ключ default не поддерживается.
+    Необязательность полей выражается через anyOf с null, который msgspec
+    и LangChain для Optional уже генерируют.
+    """
+    properties = {
+        name: {key: value for key, value in prop.items() if key != "default"}
+        for name, prop in schema.get("properties", {}).items()
+    }
+    return {
+        **schema,
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+# ProviderStrategy не умеет работать с msgspec.Struct напрямую, поэтому модели
+# отдаётся готовая JSON-схема, а ответ декодируется в AssistantResponse уже
+# через msgspec (см. MsgspecResponseMiddleware).
+_, _schema_defs = msgspec.json.schema_components([AssistantResponse])
+_ASSISTANT_SCHEMA = _strict_schema(_schema_defs["AssistantResponse"])
+
+
 # =========
 # TOOLS
 # =========
 
 
-@tool
-def get_weather_for_location(city: str) -> str:
-    """
-    Получить краткую сводку погоды для заданного города.
-
-    Параметры:
-        city: Город, для которого нужно узнать погоду (строка).
-
-    Возвращает:
-        Текстовое описание погодных условий (температура, состояние).
-    """
+async def _describe_weather(city: str, ctx: AgentContext) -> str:
+    """Текстовая сводка текущей погоды для одного города (общая часть погодных tools)."""
     city_norm = city.strip() or "неизвестный город"
 
-    weather = get_weather_by_city(city_norm)
-    if isinstance(weather, dict) and "error" in weather:
+    weather = await aget_weather_by_city(city_norm, ctx.coords_for(city_norm))
+    if is_error(weather):
         return f"Не удалось получить погоду для {city_norm}: {weather['error']}"
 
     try:
-        name = weather["name"]
-        temp = weather["main"]["temp"]
-        description = weather["weather"][0]["description"]
-        humidity = weather["main"].get("humidity")
-        wind_speed = weather.get("wind", {}).get("speed")
+        description = weather.weather[0].description
+        humidity = weather.main.humidity
+        wind_speed = weather.wind.speed if weather.wind else None
 
-        parts = [f"Текущая погода в {name}: {temp:.1f}°C, {description}"]
+        parts = [f"Текущая погода в {weather.name}: {weather.main.temp:.1f}°C, {description}"]
         if humidity is not None:
             parts.append(f"влажность {humidity}%")
         if wind_speed is not None:
@@ -131,12 +221,52 @@ def get_weather_for_location(city: str) -> str:
 
 
 @tool
-def get_forecast_for_location(city: str, day_offset: int = 1) -> str:
+async def get_weather_for_location(city: str, runtime: ToolRuntime[AgentContext]) -> str:
+    """
+    Получить краткую сводку погоды для заданного города.
+
+    Параметры:
+        city: Город, для которого нужно узнать погоду (строка).
+        runtime: ToolRuntime с контекстом AgentContext (координаты города по умолчанию).
+
+    Возвращает:
+        Текстовое описание погодных условий (температура, состояние).
+    """
+    return await _describe_weather(city, runtime.context)
+
+
+@tool
+async def get_weather_for_locations(
+    cities: list[str],
+    runtime: ToolRuntime[AgentContext],
+) -> list[str]:
+    """
+    Получить краткую сводку текущей погоды сразу для нескольких городов.
+
+    Параметры:
+        cities: Список городов (строки), например для сравнения погоды.
+        runtime: ToolRuntime с контекстом AgentContext (координаты города по умолчанию).
+
+    Возвращает:
+        Список текстовых сводок в том же порядке, что и cities.
+    """
+    # Число одновременных запросов к OpenWeatherMap ограничивает
+    # http_client.MAX_CONCURRENT_REQUESTS — общий лимит на event loop
+    return list(await asyncio.gather(*(_describe_weather(city, runtime.context) for city in cities)))
+
+
+@tool
+async def get_forecast_for_location(
+    city: str,
+    runtime: ToolRuntime[AgentContext],
+    day_offset: int = 1,
+) -> str:
     """
     Получить примерный прогноз погоды для указанного города на N дней вперёд.
 
     Параметры:
         city: Город, для которого нужен прогноз (строка).
+        runtime: ToolRuntime с контекстом AgentContext (координаты города по умолчанию).
         day_offset: На сколько дней вперёд нужен прогноз:
             0 - сегодня, 1 - завтра, 2 - послезавтра и т.д.
 
@@ -149,7 +279,7 @@ def get_forecast_for_location(city: str, day_offset: int = 1) -> str:
     if day_offset < 0:
         return "day_offset не может быть отрицательным."
 
-    daily_data = get_daily_forecast_by_city(city_norm)
+    daily_data = await aget_daily_forecast_by_city(city_norm, runtime.context.coords_for(city_norm))
     if isinstance(daily_data, dict) and "error" in daily_data:
         return f"Не удалось получить ежедневный прогноз для {city_norm}: {daily_data['error']}"
 
@@ -184,19 +314,22 @@ def get_forecast_for_location(city: str, day_offset: int = 1) -> str:
         else:
             day_label = f"через {day_offset} дней"
 
-        parts = [f"Прогноз для {city_norm} на {day_label}: {description}"]
+        # Фрагменты вместе с разделителями собираются одним "".join в конце,
+        # без промежуточных f-строк и отдельной конкатенации хвоста
+        parts = ["Прогноз для ", city_norm, " на ", day_label, ": ", description]
 
         if temp_min is not None and temp_max is not None:
-            parts.append(f"температура от {temp_min:.1f}°C до {temp_max:.1f}°C")
+            parts += (", температура от ", format(temp_min, ".1f"), "°C до ", format(temp_max, ".1f"), "°C")
         elif temp_day is not None:
-            parts.append(f"температура около {temp_day:.1f}°C")
+            parts += (", температура около ", format(temp_day, ".1f"), "°C")
 
         if humidity is not None:
-            parts.append(f"влажность {humidity}%")
+            parts += (", влажность ", str(humidity), "%")
         if wind_speed is not None:
-            parts.append(f"ветер {wind_speed} м/с")
+            parts += (", ветер ", str(wind_speed), " м/с")
 
-        return ", ".join(parts) + " (по данным OpenWeatherMap One Call)."
+        parts.append(" (по данным OpenWeatherMap One Call).")
+        return "".join(parts)
     except Exception as e:
         return f"Не удалось обработать данные ежедневного прогноза для {city_norm}: {e}"
 
@@ -213,6 +346,37 @@ def get_user_location(runtime: ToolRuntime[AgentContext]) -> str:
     return ctx.default_city
 
 
+# Имя таймзоны приходит и из аргументов tool_call, то есть от модели: кэш
+# ограничен, чтобы произвольные строки не копились в памяти процесса
+@functools.lru_cache(maxsize=64)
+def _get_zone(name: str) -> Optional[ZoneInfo]:
+    """ZoneInfo по IANA-имени (кэшируется); None, если таймзона неизвестна системе."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+@functools.lru_cache(maxsize=32)
+def _format_date(day: date) -> str:
+    """Дата в формате ДД.ММ.ГГГГ; в течение суток берётся из кэша."""
+    return f"{day:%d.%m.%Y}"
+
+
+def _now(zone: Optional[tzinfo]) -> datetime:
+    """
+    Текущее время в zone с точностью до секунды, без replace(microsecond=0).
+
+    Без zone — системное время со смещением, актуальным на этот момент:
+    astimezone() берёт его из правил ОС при каждом вызове, а не фиксирует
+    при импорте, поэтому переход на летнее/зимнее время учитывается.
+    """
+    seconds = time.time_ns() // 1_000_000_000
+    if zone is None:
+        return datetime.fromtimestamp(seconds).astimezone()
+    return datetime.fromtimestamp(seconds, tz=zone)
+
+
 @tool
 def get_current_time(
     runtime: ToolRuntime[AgentContext],
@@ -223,17 +387,47 @@ def get_current_time(
 
     Параметры:
         runtime: ToolRuntime с контекстом AgentContext.
-        timezone: Не используется на Windows (оставлен для совместимости).
+        timezone: IANA-таймзона (например, "Europe/Moscow"); по умолчанию
+            default_timezone из контекста.
 
     Возвращает:
-        Строку с локальным временем системы в ISO‑формате
-        (YYYY‑MM‑DDTHH:MM:SS), а также человеко‑читаемое описание.
+        Строку с локальным временем в ISO‑формате (YYYY‑MM‑DDTHH:MM:SS±HH:MM),
+        а также человеко‑читаемое описание. Если таймзона неизвестна системе
+        (например, нет tzdata под Windows), используется системное время.
     """
-    now = datetime.now()
-    iso_str = now.replace(microsecond=0).isoformat()
-    human = now.strftime("%d.%m.%Y %H:%M:%S")
+    zone = _get_zone(timezone or runtime.context.default_timezone)
+    now = _now(zone)
+    stamp = f"{_format_date(now.date())} {now:%H:%M:%S} (ISO: {now.isoformat()})"
+
+    if zone is None:
+        return f"Локальное системное время: {stamp}"
+    return f"Локальное время ({zone.key}): {stamp}"
+
+
+TOOLS = [
+    get_weather_for_location,
+    get_weather_for_locations,
+    get_forecast_for_location,
+    get_user_location,
+    get_current_time,
+]
+
+# bind_tools заново строит OpenAI-схему каждого BaseTool на каждый вызов
+# модели, а готовые dict-схемы пропускает как есть — строим их один раз.
 
-    return f"Локальное системное время: {human} (ISO: {iso_str})"
+
+def _compile_tool_schema(t: BaseTool) -> dict:
+    schema = convert_to_openai_tool(t, strict=True)
+    schema["function"]["parameters"] = _strict_schema(schema["function"]["parameters"])
+    return schema
+
+
+# Схемы tools собираются один раз при импорте и сразу в strict-режиме:
+# сервер OpenAI ограничивает генерацию аргументов схемой. Гарантия полная
+# только для одиночного tool_call: при parallel_tool_calls=True (см.
+# ParallelToolCallsMiddleware) OpenAI не обещает соответствие схеме,
+# и невалидные аргументы по-прежнему возвращаются модели ошибкой ToolNode.
+_TOOL_SCHEMAS = {t.name: _compile_tool_schema(t) for t in TOOLS}
 
 
 # =====================
@@ -241,14 +435,126 @@ def get_current_time(
 # =====================
 
 
+MODEL_NAME = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
 model = init_chat_model(
-    os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+    MODEL_NAME,
     api_key=os.getenv("PROXY_API_KEY"),
     base_url=os.getenv("PROXY_BASE_URL"),
     temperature=0,
 )
 
-checkpointer = InMemorySaver()
+class StructSerializer(JsonPlusSerializer):
+    """
+    Сериализатор чекпоинтов, который кодирует msgspec.Struct через msgspec.msgpack.
+
+    Остальные значения (сообщения и т.п.) идут через стандартный msgpack
+    JsonPlusSerializer. Struct-типы задаются явно: при чтении декодер
+    восстанавливает только их, без pickle и импорта произвольных классов.
+    """
+
+    def __init__(self, *structs: type[msgspec.Struct], **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._encoder = msgspec.msgpack.Encoder()
+        self._decoders = {
+            f"msgspec/{cls.__name__}": msgspec.msgpack.Decoder(cls) for cls in structs
+        }
+
+    def dumps_typed(self, obj):
+        type_ = f"msgspec/{type(obj).__name__}"
+        if isinstance(obj, msgspec.Struct) and type_ in self._decoders:
+            return type_, self._encoder.encode(obj)
+        return super().dumps_typed(obj)
+
+    def loads_typed(self, data):
+        type_, data_ = data
+        decoder = self._decoders.get(type_)
+        if decoder is not None:
+            return decoder.decode(data_)
+        return super().loads_typed(data)
+
+
+checkpointer = InMemorySaver(serde=StructSerializer(AssistantResponse))
+
+
+# =====================
+# MIDDLEWARE
+# =====================
+
+
+def _with_parallel_tool_calls(request: ModelRequest) -> ModelRequest:
+    settings = {**request.model_settings, "parallel_tool_calls": True}
+    return request.override(model_settings=settings)
+
+
+class ParallelToolCallsMiddleware(AgentMiddleware):
+    """
+    Разрешает модели запрашивать несколько независимых tools за один ход.
+
+    create_agent сам вызывает bind_tools, поэтому parallel_tool_calls
+    передаётся через model_settings запроса. Все tool_calls одного сообщения
+    ToolNode в async-режиме (ainvoke) выполняет через asyncio.gather,
+    так что время шага равно самому долгому tool, а не их сумме.
+
+    Компромисс: при параллельных вызовах OpenAI не гарантирует соответствие
+    аргументов strict-схемам tools (_TOOL_SCHEMAS). Мы сознательно выбираем
+    меньшую задержку; на structured output (response_format) это не влияет.
+    """
+
+    def wrap_model_call(self, request, handler):
+        return handler(_with_parallel_tool_calls(request))
+
+    async def awrap_model_call(self, request, handler):
+        return await handler(_with_parallel_tool_calls(request))
+
+
+def _with_precompiled_tools(request: ModelRequest) -> ModelRequest:
+    tools = [
+        _TOOL_SCHEMAS.get(t.name, t) if isinstance(t, BaseTool) else t
+        for t in request.tools
+    ]
+    return request.override(tools=tools)
+
+
+class PrecompiledToolSchemasMiddleware(AgentMiddleware):
+    """
+    Подставляет в запрос к модели заранее собранные схемы tools.
+
+    Сами tools по-прежнему выполняет ToolNode — меняется только то,
+    что уходит в bind_tools.
+    """
+
+    def wrap_model_call(self, request, handler):
+        return handler(_with_precompiled_tools(request))
+
+    async def awrap_model_call(self, request, handler):
+        return await handler(_with_precompiled_tools(request))
+
+
+def _decode_structured_response(response: ModelResponse) -> ModelResponse:
+    data = response.structured_response
+    if not isinstance(data, dict):
+        return response
+
+    # В strict-режиме схему соблюдает сам сервер OpenAI, поэтому ValidationError
+    # здесь означает рассинхрон схемы и AssistantResponse. Поднимаем то же
+    # исключение, что и ProviderStrategy при невалидном JSON, — вызывающему
+    # коду достаточно ловить один тип
+    try:
+        structured = msgspec.convert(data, AssistantResponse)
+    except msgspec.ValidationError as exc:
+        raise StructuredOutputValidationError("AssistantResponse", exc, response.result[-1]) from exc
+    return ModelResponse(result=response.result, structured_response=structured)
+
+
+class MsgspecResponseMiddleware(AgentMiddleware):
+    """Декодирует structured_response из dict в AssistantResponse через msgspec."""
+
+    def wrap_model_call(self, request, handler):
+        return _decode_structured_response(handler(request))
+
+    async def awrap_model_call(self, request, handler):
+        return _decode_structured_response(await handler(request))
 
 
 # =====================
@@ -257,58 +563,219 @@ checkpointer = InMemorySaver()
 
 agent = create_agent(
     model=model,
-    tools=[get_weather_for_location, get_forecast_for_location, get_user_location, get_current_time],
+    tools=TOOLS,
     system_prompt=SYSTEM_PROMPT,
     context_schema=AgentContext,
-    response_format=ToolStrategy(AssistantResponse),
+    # Нативный structured output (response_format=json_schema, strict=True)
+    # вместо structured-tool: ответ приходит обычным текстом-JSON по схеме.
+    # Повторов при ошибке разбора нет: отказ модели или ответ, обрезанный
+    # по длине, поднимают StructuredOutputValidationError (см. _ask)
+    response_format=ProviderStrategy(_ASSISTANT_SCHEMA, strict=True),
     checkpointer=checkpointer,
+    middleware=[
+        PrecompiledToolSchemasMiddleware(),
+        ParallelToolCallsMiddleware(),
+        MsgspecResponseMiddleware(),
+    ],
 )
 
 
+# ==========================
+# СПЕКУЛЯТИВНЫЙ PREFETCH
+# ==========================
+
+# Признаки в тексте запроса, по которым погоду/прогноз для города пользователя
+# можно начать загружать ещё до того, как LLM решит вызвать tool
+_WEATHER_HINTS = ("погод", "температур", "холод", "тепл", "жар", "дожд", "снег", "ветер", "weather")
+_FORECAST_HINTS = ("завтра", "прогноз", "выходн", "недел", "forecast", "tomorrow")
+
+
+def _speculative_prefetch(messages: list[dict], context: AgentContext) -> list[asyncio.Task]:
+    """
+    Запустить в фоне загрузку погоды/прогноза для context.default_city.
+
+    Пока модель думает над первым шагом, запрос к OpenWeatherMap уже идёт.
+    Когда модель вызовет tool для этого же города, он получит результат из
+    кэша weather_app или дождётся уже начатого запроса, а не сделает новый.
+    Промах по ключевым словам стоит один лишний (кэшируемый) запрос к API.
+    """
+    text = " ".join(
+        str(m.get("content", "")) for m in messages if m.get("role") == "user"
+    ).lower()
+    city, coords = context.default_city, context.default_coords
+
+    tasks = []
+    if any(hint in text for hint in _WEATHER_HINTS):
+        tasks.append(asyncio.create_task(aget_weather_by_city(city, coords)))
+    if any(hint in text for hint in _FORECAST_HINTS):
+        tasks.append(asyncio.create_task(aget_daily_forecast_by_city(city, coords)))
+    return tasks
+
+
+# =====================
+# КЭШ ОТВЕТОВ
+# =====================
+
+response_cache = LLMCache()
+
+
+def _cache_context(context: AgentContext) -> list:
+    """Поля контекста, от которых зависит ответ агента (без user_id и имени)."""
+    return [city_cache_key(context.default_city), context.default_timezone, context.default_coords]
+
+
+async def ainvoke_cached(messages: list[dict], *, config: dict, context: AgentContext) -> dict:
+    """
+    agent.ainvoke с кэшем готового ответа для одинаковых запросов.
+
+    Ключ строится только из того, что влияет на ответ: модель, системный
+    промпт, предыдущие вопросы пользователя в треде, новые сообщения и
+    город/таймзона/координаты из контекста (_cache_context). user_id, имя и
+    ответы модели в ключ не входят, поэтому одинаковый диалог разных
+    пользователей одного города использует общую запись. При попадании LLM и
+    tools не вызываются, а в тред дописываются запрос и ответ, чтобы
+    следующие вопросы видели этот шаг. При промахе параллельно с первым
+    шагом LLM запускается спекулятивный prefetch погоды (_speculative_prefetch).
+
+    Ответы с local_time не кэшируются: время устарело бы на срок до TTL.
+    """
+    state = await agent.aget_state(config)
+    # Follow-up («а завтра?») зависит от предыдущих вопросов, но не от текста
+    # ответов модели и результатов tools — они у каждого треда свои
+    questions = [m.content for m in state.values.get("messages", []) if m.type == "human"]
+    key = cache_key(MODEL_NAME, SYSTEM_PROMPT, [questions, messages], _cache_context(context))
+
+    cached = await response_cache.get(key)
+    if cached is not None:
+        structured = msgspec.json.decode(cached, type=AssistantResponse)
+        await agent.aupdate_state(
+            config,
+            {
+                "messages": [*messages, AIMessage(content=cached.decode())],
+                "structured_response": structured,
+            },
+            as_node="model",
+        )
+        state = await agent.aget_state(config)
+        return state.values
+
+    prefetch = _speculative_prefetch(messages, context)
+    try:
+        result = await agent.ainvoke({"messages": messages}, config=config, context=context)
+    finally:
+        # Обычно к этому моменту prefetch давно завершён; ждём, чтобы не оставлять
+        # висящих задач (ошибки уже превращены weather_app в dict с "error")
+        await asyncio.gather(*prefetch, return_exceptions=True)
+
+    structured = result.get("structured_response")
+    if structured is not None and structured.local_time is None:
+        await response_cache.set(key, msgspec.json.encode(structured))
+    return result
+
+
+# =====================
+# СТРИМИНГ ОТВЕТА
+# =====================
+
+
+async def astream_response(
+    messages: list[dict], *, config: dict, context: AgentContext
+) -> AsyncIterator[Union[dict, AssistantResponse]]:
+    """
+    Стриминговый вариант вызова агента.
+
+    По мере того как модель генерирует JSON-ответ по схеме AssistantResponse,
+    отдаёт dict с уже разобранными полями (частичный JSON дочитывается
+    через parse_partial_json), так что summary можно показывать
+    пользователю до окончания генерации. Последним элементом отдаётся
+    готовый AssistantResponse из состояния треда.
+
+    Tools, как и в ainvoke, запускаются после завершения сообщения модели
+    (так устроен цикл create_agent); перекрытие сети с генерацией даёт
+    спекулятивный prefetch.
+    """
+    # run_id вызова модели -> накопленный текст ответа. С response_format=json_schema
+    # текст сообщения модели — это и есть JSON AssistantResponse
+    buffers: dict[str, str] = {}
+    last_partial = None
+
+    prefetch = _speculative_prefetch(messages, context)
+    try:
+        async for event in agent.astream_events(
+            {"messages": messages}, config=config, context=context, version="v2"
+        ):
+            if event["event"] != "on_chat_model_stream":
+                continue
+
+            text = event["data"]["chunk"].text
+            if not text:
+                continue
+
+            buffer = buffers[event["run_id"]] = buffers.get(event["run_id"], "") + text
+            partial = parse_partial_json(buffer)
+            if isinstance(partial, dict) and partial != last_partial:
+                last_partial = partial
+                yield partial
+    finally:
+        await asyncio.gather(*prefetch, return_exceptions=True)
+
+    state = await agent.aget_state(config)
+    structured = state.values.get("structured_response")
+    if structured is not None:
+        yield structured
+
+
 # =====================
 # ПРИМЕР ИСПОЛЬЗОВАНИЯ
 # =====================
 
-if __name__ == "__main__":
+
+async def _ask(question: str, *, config: dict, context: AgentContext) -> Optional[AssistantResponse]:
+    """Задать агенту один вопрос; None, если модель не вернула ответ по схеме."""
+    try:
+        result = await ainvoke_cached(
+            [{"role": "user", "content": question}],
+            config=config,
+            context=context,
+        )
+    except StructuredOutputValidationError as exc:
+        # Отказ модели или обрезанный по длине JSON не разбираются как AssistantResponse
+        print(f"Не удалось получить структурированный ответ: {exc.source}")
+        return None
+    return result["structured_response"]
+
+
+async def main() -> None:
+    # DNS и TLS до OpenWeatherMap прогреваются в фоне, пока модель думает
+    # над первым шагом, а не внутри первого вызова погодного tool
+    warmup = asyncio.create_task(aprewarm())
+
     thread_id = "demo-thread-1"
     config = {"configurable": {"thread_id": thread_id}}
 
-    context = AgentContext(
+    # Геокодинг асинхронный, поэтому задача прогрева успевает стартовать
+    context = await AgentContext.acreate(
         user_id="user-1",
         user_name="Иван",
         default_city="Иркутск,ru",
         default_timezone="Europe/Moscow",
     )
 
-    result1 = agent.invoke(
-        {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "Какая у меня сейчас погода и который час?",
-                }
-            ]
-        },
-        config=config,
-        context=context,
-    )
+    # Погодные tools асинхронные, поэтому агент вызывается через ainvoke
+    answer1 = await _ask("Какая у меня сейчас погода и который час?", config=config, context=context)
 
     print("=== Первый ответ: structured_response ===")
-    print(result1["structured_response"])
-
-    result2 = agent.invoke(
-        {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "А завтра будет холоднее?",
-                }
-            ]
-        },
-        config=config,
-        context=context,
-    )
+    print(answer1)
+
+    answer2 = await _ask("А завтра будет холоднее?", config=config, context=context)
 
     print("\n=== Второй ответ: structured_response ===")
-    print(result2["structured_response"])
+    print(answer2)
+
+    await warmup
+    # Клиент httpx привязан к этому event loop — закрываем его вместе с циклом
+    await aclose()
 
+
+if __name__ == "__main__":
+    asyncio.run(main())
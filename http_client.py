@@ -1,42 +1,295 @@
-import time
-from typing import Optional
+import asyncio
+import functools
+import random
+import weakref
+from typing import Optional, Union
 
+import httpx
 import requests
+from pybreaker import CircuitBreaker, CircuitBreakerError
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+
+# Таймауты одной попытки (сек): недоступный хост отсекается за CONNECT_TIMEOUT,
+# а зависший ответ — за READ_TIMEOUT, не растягивая вызов tool на десятки секунд
+CONNECT_TIMEOUT = 2.0
+READ_TIMEOUT = 5.0
+# Сколько простаивающее соединение живёт в пуле httpx (сек). По умолчанию 5 с —
+# меньше первого шага LLM, и соединения aprewarm закрывались бы до первого tool
+KEEPALIVE_SECONDS = 30.0
+
+# Сколько асинхронных запросов одновременно уходит во внешний API (бережёт rate
+# limit OpenWeatherMap). Лимит общий для всех tools, параллельных tool_calls
+# и спекулятивного prefetch, работающих в одном event loop.
+MAX_CONCURRENT_REQUESTS = 10
+
+# Асинхронный клиент и семафор запросов по event loop: пул соединений и keep-alive
+# переиспользуются между вызовами, поэтому повторные запросы к одному хосту
+# не платят за новое TCP/TLS-соединение. И соединения httpx, и asyncio.Semaphore
+# привязываются к циклу, в котором впервые использованы, поэтому у каждого цикла
+# (например, у каждого asyncio.run) своя пара.
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, asyncio.Semaphore]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# Статусы, при которых запрос имеет смысл повторить: rate limit и сбои сервера
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Случайная добавка к паузе (сек), чтобы параллельные клиенты не повторяли синхронно
+BACKOFF_JITTER = 0.3
+# Максимальная пауза между попытками (сек). Если сервер в Retry-After просит
+# ждать дольше, повторов не будет — ответ 429/503 сразу возвращается вызывающему,
+# чтобы один rate limit не подвешивал ход агента на минуты или часы
+MAX_RETRY_DELAY_SECONDS = 10
+# Политика повторов по умолчанию для get_with_retries / aget_with_retries
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+# Circuit breaker для внешнего API: после BREAKER_FAIL_MAX подряд неудачных
+# запросов (сервер не ответил или вернул 429/5xx после всех повторов)
+# следующие BREAKER_RESET_SECONDS запросы сразу завершаются CircuitBreakerError,
+# без сети и ретраев. Затем один пробный запрос решает, закрыть ли breaker.
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_SECONDS = 30
+
+
+class _CappedRetry(Retry):
+    """Retry, который не ждёт дольше retry_after_max: такой ответ возвращается без повторов."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry_after = _retry_after_seconds(response.headers.get("Retry-After", "")) if response else None
+        if retry_after is not None and retry_after > self.retry_after_max:
+            # С raise_on_status=False urllib3 в этом случае отдаёт ответ как есть
+            raise MaxRetryError(_pool, url, ResponseError("Retry-After больше retry_after_max"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class _UnavailableResponse(Exception):
+    """Неудачная попытка для учёта в CIRCUIT_BREAKER; наружу не выходит."""
+
+    def __init__(self, response: Optional[Union[requests.Response, httpx.Response]] = None) -> None:
+        super().__init__(response)
+        self.response = response
+
+
+def _not_unavailable(exc: BaseException) -> bool:
+    """Всё, кроме _UnavailableResponse (отмена задачи, ошибки кода), breaker не считает сбоем."""
+    return not isinstance(exc, _UnavailableResponse)
+
+
+CIRCUIT_BREAKER = CircuitBreaker(
+    fail_max=BREAKER_FAIL_MAX,
+    reset_timeout=BREAKER_RESET_SECONDS,
+    exclude=[_not_unavailable],
+)
+
+
+def _loop_http() -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    """Клиент и семафор запросов текущего event loop (создаются при первом вызове)."""
+    loop = asyncio.get_running_loop()
+    pair = _ASYNC_CLIENTS.get(loop)
+    if pair is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(keepalive_expiry=KEEPALIVE_SECONDS),
+        )
+        pair = _ASYNC_CLIENTS[loop] = (client, asyncio.Semaphore(MAX_CONCURRENT_REQUESTS))
+    return pair
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx.AsyncClient текущего event loop."""
+    return _loop_http()[0]
+
+
+async def aclose() -> None:
+    """Закрывает клиент текущего event loop; вызывайте перед завершением цикла."""
+    pair = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if pair is not None:
+        await pair[0].aclose()
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(retries: int = DEFAULT_RETRIES, backoff_seconds: float = DEFAULT_BACKOFF_SECONDS) -> requests.Session:
+    """
+    Возвращает общий requests.Session с пулом соединений и ретраями urllib3.
+
+    Сессия создаётся один раз на каждую пару (retries, backoff_seconds),
+    поэтому TCP/TLS-соединения к OpenWeatherMap переиспользуются между вызовами.
+    lru_cache различает позиционные и именованные аргументы, поэтому
+    вызывайте её всегда позиционно — как get_with_retries.
+    """
+    retry = _CappedRetry(
+        # retries — общее число попыток, а Retry.total считает только повторы
+        total=max(retries - 1, 0),
+        backoff_factor=backoff_seconds,
+        backoff_jitter=BACKOFF_JITTER,
+        backoff_max=MAX_RETRY_DELAY_SECONDS,
+        retry_after_max=MAX_RETRY_DELAY_SECONDS,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        # После последней попытки возвращаем ответ как есть, а не исключение
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Та же сессия (тот же ключ lru_cache), что get_with_retries берёт с параметрами по умолчанию
+SESSION = get_session(DEFAULT_RETRIES, DEFAULT_BACKOFF_SECONDS)
 
 
 def get_with_retries(
     url: str,
     *,
-    retries: int = 3,
-    backoff_seconds: float = 1.0,
-    timeout: float = 10.0,
+    retries: int = DEFAULT_RETRIES,
+    backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+    timeout: float = READ_TIMEOUT,
 ) -> Optional[requests.Response]:
     """
     Простой HTTP-клиент с повторными попытками для GET-запросов.
 
+    Запросы идут через общий пул соединений (get_session), повторы при
+    ошибках сети и ответах 429/5xx выполняет urllib3 Retry с учётом Retry-After.
+
     Параметры:
         url: Полный URL.
         retries: Количество попыток при временных ошибках сети/сервера.
-        backoff_seconds: Базовая пауза между попытками (линейный backoff).
-        timeout: Таймаут одного запроса в секундах.
+        backoff_seconds: Базовая пауза между попытками (экспоненциальный backoff с jitter).
+        timeout: Таймаут чтения ответа в секундах (на соединение — CONNECT_TIMEOUT).
 
     Возвращает:
         requests.Response при успехе или None при фатальной ошибке.
+
+    Исключения:
+        CircuitBreakerError: breaker открыт после серии сбоев, запрос не выполнялся.
+    """
+    session = get_session(retries, backoff_seconds)
+
+    try:
+        with CIRCUIT_BREAKER.calling():
+            try:
+                resp = session.get(url, timeout=(CONNECT_TIMEOUT, timeout))
+            except (requests.ConnectionError, requests.Timeout):
+                # Все попытки упали.
+                raise _UnavailableResponse()
+            if resp.status_code in RETRY_STATUSES:
+                raise _UnavailableResponse(resp)
+    except _UnavailableResponse as exc:
+        return exc.response
+
+    # Если сервер ответил, даже с 4xx, возвращаем как есть –
+    # разбор ошибок делается на уровне вызывающего кода.
+    return resp
+
+
+async def aget_with_retries(
+    url: str,
+    *,
+    retries: int = DEFAULT_RETRIES,
+    backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+    timeout: float = READ_TIMEOUT,
+) -> Optional[httpx.Response]:
     """
-    last_exc: Exception | None = None
+    Асинхронный аналог get_with_retries поверх общего httpx.AsyncClient
+    текущего event loop (get_async_client).
 
-    for attempt in range(1, retries + 1):
-        try:
-            resp = requests.get(url, timeout=timeout)
-            # Если сервер ответил, даже с 4xx/5xx, возвращаем как есть –
-            # разбор ошибок делается на уровне вызывающего кода.
-            return resp
-        except (requests.ConnectionError, requests.Timeout) as exc:
-            last_exc = exc
-            if attempt == retries:
-                break
-            time.sleep(backoff_seconds * attempt)
+    Пауза между попытками не блокирует event loop, поэтому несколько
+    запросов (например, погода и прогноз) могут выполняться параллельно.
+    Политика повторов та же, что у синхронной версии: ошибки сети и ответы
+    из RETRY_STATUSES, пауза из Retry-After или экспоненциальная с jitter.
+
+    Параметры:
+        url: Полный URL.
+        retries: Количество попыток при временных ошибках сети/сервера.
+        backoff_seconds: Базовая пауза между попытками (экспоненциальный backoff с jitter).
+        timeout: Таймаут чтения ответа в секундах (на соединение — CONNECT_TIMEOUT).
+
+    Возвращает:
+        httpx.Response при успехе или None при фатальной ошибке.
+
+    Исключения:
+        CircuitBreakerError: breaker открыт после серии сбоев, запрос не выполнялся.
+    """
+    client, slots = _loop_http()
+    resp: Optional[httpx.Response] = None
+    request_timeout = httpx.Timeout(timeout, connect=CONNECT_TIMEOUT)
 
-    # Если сюда дошли – все попытки упали.
-    return None
+    try:
+        # calling() — синхронный контекстный менеджер, поэтому внутри можно await:
+        # состояние breaker проверяется на входе, результат учитывается на выходе
+        with CIRCUIT_BREAKER.calling():
+            for attempt in range(1, retries + 1):
+                try:
+                    # Слот занимается только на время запроса, не на паузу между попытками
+                    async with slots:
+                        resp = await client.get(url, timeout=request_timeout)
+                    # Как и в синхронной версии, остальные 4xx разбирает вызывающий код.
+                    if resp.status_code not in RETRY_STATUSES:
+                        return resp
+                except httpx.TransportError:
+                    # Любая ошибка сети/протокола (соединение, таймауты, обрыв ответа,
+                    # пул) — как requests.ConnectionError/Timeout в синхронной версии
+                    resp = None
 
+                if attempt < retries:
+                    delay = _retry_delay(resp, attempt, backoff_seconds)
+                    if delay is None:
+                        # Сервер просит ждать дольше MAX_RETRY_DELAY_SECONDS — не ждём
+                        break
+                    await asyncio.sleep(delay)
+
+            # Все попытки исчерпаны: последний ответ 429/5xx или None, если сервер недоступен.
+            raise _UnavailableResponse(resp)
+    except _UnavailableResponse as exc:
+        return exc.response
+
+
+def _retry_after_seconds(value: str) -> Optional[float]:
+    """Retry-After в секундах; None, если заголовка нет или он задан датой."""
+    value = value.strip()
+    return float(value) if value.isdigit() else None
+
+
+def _retry_delay(resp: Optional[httpx.Response], attempt: int, backoff_seconds: float) -> Optional[float]:
+    """
+    Пауза перед повтором: Retry-After сервера или экспоненциальный backoff с jitter,
+    не больше MAX_RETRY_DELAY_SECONDS. None — сервер просит ждать дольше, повторять не нужно.
+    """
+    retry_after = _retry_after_seconds(resp.headers.get("Retry-After", "")) if resp is not None else None
+    if retry_after is not None:
+        return retry_after if retry_after <= MAX_RETRY_DELAY_SECONDS else None
+    backoff = backoff_seconds * 2 ** (attempt - 1) + random.uniform(0, BACKOFF_JITTER)
+    return min(backoff, MAX_RETRY_DELAY_SECONDS)
+
+
+# Адреса, соединение с которыми стоит открыть заранее (DNS + TCP + TLS).
+# Геокодинг weather_app ходит по http://, погода и прогноз — по https://,
+# а пул httpx держит отдельные соединения для каждой схемы.
+PREWARM_URLS = ("https://api.openweathermap.org/", "http://api.openweathermap.org/")
+PREWARM_TIMEOUT = 2.0
+
+
+async def aprewarm(urls: tuple[str, ...] = PREWARM_URLS) -> None:
+    """
+    Открывает соединения к urls в пуле клиента текущего event loop при старте процесса.
+
+    Первый реальный запрос tools тогда не платит за DNS и TLS-рукопожатие
+    внутри ответа пользователю. Ошибки игнорируются: прогрев — только
+    оптимизация, и через CIRCUIT_BREAKER эти запросы не идут.
+
+    Соединения httpx привязаны к event loop, поэтому вызывать нужно в том же
+    цикле, где потом работает агент, — например, через asyncio.create_task
+    в начале main(), чтобы прогрев шёл параллельно со стартом.
+    """
+    client = get_async_client()
+    await asyncio.gather(
+        *(client.head(url, timeout=PREWARM_TIMEOUT) for url in urls),
+        return_exceptions=True,
+    )
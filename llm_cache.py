@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from cachetools import TTLCache
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # Redis не обязателен: без него кэш живёт в памяти процесса
+    redis = None
+
+
+# Ответы про погоду/время быстро устаревают, поэтому TTL короткий
+DEFAULT_TTL_SECONDS = 60
+DEFAULT_MAXSIZE = 1024
+
+
+def cache_key(model_name: str, system_prompt: str, messages: Any, context: Any = None) -> str:
+    """
+    Строит ключ кэша для запроса к агенту.
+
+    Параметры:
+        model_name: Имя LLM-модели.
+        system_prompt: Системный промпт агента.
+        messages: JSON-совместимое представление сообщений (история + новый запрос).
+        context: JSON-совместимый контекст пользователя (город, таймзона и т.п.).
+
+    Возвращает:
+        Строку вида "llm:<blake2b-hex>".
+    """
+    payload = json.dumps(
+        [model_name, system_prompt, messages, context],
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    digest = hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+    return f"llm:{digest}"
+
+
+class LLMCache:
+    """
+    Кэш готовых ответов агента с TTL.
+
+    Если задан REDIS_URL (и установлен пакет redis) — хранит ответы в Redis
+    через SETEX, иначе в TTLCache в памяти процесса. Значения — байты,
+    сериализацией занимается вызывающий код.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: int = DEFAULT_TTL_SECONDS,
+        maxsize: int = DEFAULT_MAXSIZE,
+        redis_url: Optional[str] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        self._redis = redis.from_url(redis_url) if redis and redis_url else None
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if self._redis is not None:
+            value = await self._redis.get(key)
+        else:
+            value = self._memory.get(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes) -> None:
+        if self._redis is not None:
+            await self._redis.setex(key, self.ttl, value)
+        else:
+            self._memory[key] = value
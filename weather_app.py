@@ -1,10 +1,15 @@
-import requests
 from dotenv import load_dotenv
 import os
 import http_client
 import json
 from datetime import datetime, timedelta
 import hashlib
+import asyncio
+import functools
+import inspect
+import threading
+import msgspec
+from cachetools import LRUCache, TTLCache
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -16,6 +21,18 @@ if not API_KEY:
 CACHE_DIR = '.cache'
 CACHE_DURATION = timedelta(minutes=10)
 
+# In-memory кэш по городу: повторный запрос того же города не идёт ни в сеть,
+# ни в файловый кэш (геокодинг тоже пропускается)
+MEMORY_CACHE_MAXSIZE = 512
+MEMORY_CACHE_TTL_SECONDS = 120
+
+# Координаты города практически не меняются, поэтому геокодинг кэшируется без TTL
+COORDINATES_CACHE = LRUCache(maxsize=1024)
+
+# Ответ, когда circuit breaker в http_client открыт: OpenWeatherMap недавно
+# подряд не отвечал, и запрос даже не отправлялся
+SERVICE_UNAVAILABLE = "Сервис погоды временно недоступен"
+
 if not os.path.exists(CACHE_DIR):
     os.makedirs(CACHE_DIR)
 
@@ -40,6 +57,24 @@ def save_to_cache_by_key(data: dict, lat: float, lon: float, endpoint: str):
     with open(cache_file, 'w', encoding='utf-8') as f:
         json.dump(cache_data, f, ensure_ascii=False, indent=2)
 
+def save_raw_to_cache_by_key(content: bytes, lat: float, lon: float, endpoint: str):
+    """Сохраняет в кэш сырой JSON ответа API как есть, без повторного разбора и сериализации"""
+    cache_key = get_cache_key(lat, lon, endpoint)
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
+
+    # Формат файла тот же, что у save_to_cache_by_key: msgspec.Raw вставляет
+    # байты ответа в поле data без декодирования
+    cache_data = {
+        'fetched_at': datetime.now().isoformat(),
+        'lat': lat,
+        'lon': lon,
+        'endpoint': endpoint,
+        'data': msgspec.Raw(content)
+    }
+
+    with open(cache_file, 'wb') as f:
+        f.write(msgspec.json.encode(cache_data))
+
 def load_from_cache_by_key(lat: float, lon: float, endpoint: str) -> dict:
     """Загружает данные из кэша по ключу"""
     cache_key = get_cache_key(lat, lon, endpoint)
@@ -58,17 +93,151 @@ def load_from_cache_by_key(lat: float, lon: float, endpoint: str) -> dict:
     return None
 
 
+# Типизированная схема ответа /data/2.5/weather (только используемые поля,
+# остальные msgspec пропускает при декодировании)
+class WeatherMain(msgspec.Struct):
+    temp: float
+    humidity: int | None = None
+
+
+class Weather(msgspec.Struct):
+    description: str
+
+
+class Wind(msgspec.Struct):
+    # int | float: целая скорость из API остаётся целой ("ветер 2 м/с", а не "2.0")
+    speed: int | float | None = None
+
+
+class WeatherResp(msgspec.Struct):
+    name: str
+    main: WeatherMain
+    weather: list[Weather]
+    wind: Wind | None = None
+
+
+# Типизированный декодер: JSON ответа разбирается сразу в WeatherResp за один проход
+WEATHER_DECODER = msgspec.json.Decoder(WeatherResp)
+
+
+def is_error(result) -> bool:
+    """Проверяет, что функция вернула dict с ошибкой, а не данные"""
+    return isinstance(result, dict) and "error" in result
+
+
+def city_cache_key(city: str) -> str:
+    """Нормализует название города для in-memory кэша"""
+    return city.strip().lower()
+
+
+def ttl_cache(maxsize: int = MEMORY_CACHE_MAXSIZE, ttl: float = MEMORY_CACHE_TTL_SECONDS):
+    """Кэширует успешные ответы функции от города в TTLCache (LRU + время жизни).
+
+    Работает и для обычных, и для async-функций. Ключ — только город:
+    дополнительные аргументы (например, coords) на результат не влияют.
+    Ответы с ключом "error" не кэшируются, чтобы временный сбой не залипал на весь TTL.
+    """
+    def decorator(func):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        if inspect.iscoroutinefunction(func):
+            # Запросы, которые сейчас выполняются: одновременные вызовы для одного
+            # города (например, спекулятивный prefetch и вызов tool) ждут один запрос.
+            # Операции с кэшем не содержат await, поэтому блокировка не нужна.
+            inflight = {}
+
+            async def load(key: str, city: str, args, kwargs) -> dict:
+                try:
+                    result = await func(city, *args, **kwargs)
+                    if not is_error(result):
+                        cache[key] = result
+                    return result
+                finally:
+                    inflight.pop(key, None)
+
+            @functools.wraps(func)
+            async def async_wrapper(city: str, *args, **kwargs) -> dict:
+                key = city_cache_key(city)
+                cached = cache.get(key)
+                if cached is not None:
+                    return cached
+
+                task = inflight.get(key)
+                if task is None:
+                    task = asyncio.ensure_future(load(key, city, args, kwargs))
+                    inflight[key] = task
+                # shield: отмена одного ожидающего не отменяет запрос для остальных
+                return await asyncio.shield(task)
+
+            async_wrapper.cache = cache
+            return async_wrapper
+
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(city: str, *args, **kwargs) -> dict:
+            key = city_cache_key(city)
+            with lock:
+                cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+            result = func(city, *args, **kwargs)
+            if not is_error(result):
+                with lock:
+                    cache[key] = result
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
 def get_coordinates(city: str) -> tuple:
-    """Получает координаты города"""
+    """Получает координаты города (результат запоминается в COORDINATES_CACHE)"""
+    key = city_cache_key(city)
+    coords = COORDINATES_CACHE.get(key)
+    if coords:
+        return coords
+
     url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}"
-    response = requests.get(url)
-    if response.status_code == 200:
+    response = http_client.get_with_retries(url)
+    if response and response.status_code == 200:
         data = response.json()
         if data:
-            return data[0]['lat'], data[0]['lon']
+            coords = data[0]['lat'], data[0]['lon']
+            COORDINATES_CACHE[key] = coords
+            return coords
     else:
-        print(f"Ошибка: {response.status_code}")
-        return None
+        print(f"Ошибка: {response.status_code if response is not None else 'Нет ответа'}")
+    return None
+
+
+async def aget_coordinates(city: str) -> tuple:
+    """Асинхронно получает координаты города (общий кэш с get_coordinates)"""
+    key = city_cache_key(city)
+    coords = COORDINATES_CACHE.get(key)
+    if coords:
+        return coords
+
+    url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}"
+    try:
+        response = await http_client.aget_with_retries(url)
+        if response and response.status_code == 200:
+            data = response.json()
+            if data:
+                coords = data[0]['lat'], data[0]['lon']
+                COORDINATES_CACHE[key] = coords
+                return coords
+        else:
+            print(f"Ошибка: {response.status_code if response else 'Нет ответа'}")
+    except http_client.CircuitBreakerError:
+        # Открытый breaker вызывающий код превращает в SERVICE_UNAVAILABLE
+        raise
+    except Exception as e:
+        print(f"Ошибка геокодинга: {e}")
+    return None
 
 
 def get_current_weather(city: str = None, latitude: float = None, longitude: float = None) -> dict:
@@ -102,8 +271,12 @@ def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
         return {"error": f"Ошибка получения погоды: {e}"}
 
 
+@ttl_cache()
 def get_weather_by_city(city: str) -> dict:
-    coords = get_coordinates(city)
+    try:
+        coords = get_coordinates(city)
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
     if not coords:
         return {"error": "Город не найден"}
     
@@ -122,6 +295,47 @@ def get_weather_by_city(city: str) -> dict:
             return data
         else:
             return {"error": f"Ошибка запроса: {response.status_code if response else 'Нет ответа'}"}
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
+    except Exception as e:
+        return {"error": f"Ошибка получения погоды: {e}"}
+
+
+@ttl_cache()
+async def aget_weather_by_city(city: str, coords: tuple | None = None) -> WeatherResp | dict:
+    """Асинхронная версия get_weather_by_city (не блокирует event loop).
+
+    Если координаты города уже известны (coords), геокодинг пропускается.
+    Возвращает типизированный WeatherResp или dict с ключом "error".
+    """
+    try:
+        coords = coords or await aget_coordinates(city)
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
+    if not coords:
+        return {"error": "Город не найден"}
+
+    lat, lon = coords
+    try:
+        cached = load_from_cache_by_key(lat, lon, 'weather')
+        if cached:
+            return msgspec.convert(cached, WeatherResp)
+    except msgspec.ValidationError:
+        pass
+
+    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={API_KEY}&units=metric&lang=ru"
+
+    try:
+        response = await http_client.aget_with_retries(url)
+        if response and response.status_code == 200:
+            weather = WEATHER_DECODER.decode(response.content)
+            # Полный ответ нужен синхронным функциям, читающим тот же файловый кэш
+            save_raw_to_cache_by_key(response.content, lat, lon, 'weather')
+            return weather
+        else:
+            return {"error": f"Ошибка запроса: {response.status_code if response else 'Нет ответа'}"}
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
     except Exception as e:
         return {"error": f"Ошибка получения погоды: {e}"}
 
@@ -161,6 +375,103 @@ def get_hourly_weather(latitude: float, longitude: float) -> dict:
         return {"error": f"Ошибка получения почасового прогноса: {e}"}
 
 
+def _aggregate_daily_forecast(raw: dict) -> dict:
+    """Агрегирует сырой ответ /data/2.5/forecast (шаг 3 часа) по локальным датам."""
+    items = raw.get("list")
+    if not items:
+        return {"error": "Неожиданная структура ответа forecast: нет поля 'list'"}
+
+    # Таймзона города (секунды смещения от UTC) — чтобы группировать по ЛОКАЛЬНЫМ датам
+    city_info = raw.get("city") or {}
+    tz_offset = city_info.get("timezone", 0) or 0
+
+    # Агрегируем по локальной дате (UTC + tz_offset)
+    from collections import defaultdict
+
+    days = defaultdict(
+        lambda: {
+            "temps_min": [],
+            "temps_max": [],
+            "temps": [],
+            "humidities": [],
+            "wind_speeds": [],
+            "descriptions": [],
+        }
+    )
+
+    for item in items:
+        try:
+            dt_ts = item.get("dt")
+            if dt_ts is None:
+                continue
+            dt_utc = datetime.utcfromtimestamp(dt_ts)
+            dt_local = dt_utc + timedelta(seconds=tz_offset)
+            date_key = dt_local.date().isoformat()
+
+            main = item.get("main") or {}
+            weather_list = item.get("weather") or []
+            wind = item.get("wind") or {}
+
+            temp = main.get("temp")
+            temp_min = main.get("temp_min")
+            temp_max = main.get("temp_max")
+            humidity = main.get("humidity")
+            descr = weather_list[0].get("description") if weather_list else None
+            wind_speed = wind.get("speed")
+
+            day = days[date_key]
+            if temp is not None:
+                day["temps"].append(temp)
+            if temp_min is not None:
+                day["temps_min"].append(temp_min)
+            if temp_max is not None:
+                day["temps_max"].append(temp_max)
+            if humidity is not None:
+                day["humidities"].append(humidity)
+            if wind_speed is not None:
+                day["wind_speeds"].append(wind_speed)
+            if descr:
+                day["descriptions"].append(descr)
+        except Exception:
+            # Пропускаем странные записи, не роняя всё
+            continue
+
+    # Формируем daily‑список, отсортированный по дате
+    daily_list = []
+    for date_key in sorted(days.keys()):
+        d = days[date_key]
+
+        def avg(values):
+            return sum(values) / len(values) if values else None
+
+        temp_min = min(d["temps_min"]) if d["temps_min"] else None
+        temp_max = max(d["temps_max"]) if d["temps_max"] else None
+        temp_day = avg(d["temps"])
+        humidity = avg(d["humidities"])
+        wind_speed = avg(d["wind_speeds"])
+
+        # самая частая формулировка погоды за день
+        description = None
+        if d["descriptions"]:
+            from collections import Counter
+
+            description = Counter(d["descriptions"]).most_common(1)[0][0]
+
+        daily_list.append(
+            {
+                "date": date_key,
+                "temp": {"min": temp_min, "max": temp_max, "day": temp_day},
+                "humidity": humidity,
+                "wind_speed": wind_speed,
+                "weather": (
+                    [{"description": description}] if description else []
+                ),
+            }
+        )
+
+    return {"daily": daily_list}
+
+
 def get_daily_forecast(latitude: float, longitude: float) -> dict:
     """Получает агрегированный дневной прогноз (до ~5 дней вперёд) по координатам.
 
@@ -201,110 +512,24 @@ def get_daily_forecast(latitude: float, longitude: float) -> dict:
                 f"{response.status_code} {response.text}"
             }
 
-        raw = response.json()
-        items = raw.get("list")
-        if not items:
-            return {"error": "Неожиданная структура ответа forecast: нет поля 'list'"}
-
-        # Таймзона города (секунды смещения от UTC) — чтобы группировать по ЛОКАЛЬНЫМ датам
-        city_info = raw.get("city") or {}
-        tz_offset = city_info.get("timezone", 0) or 0
-
-        # Агрегируем по локальной дате (UTC + tz_offset)
-        from collections import defaultdict
-
-        days = defaultdict(
-            lambda: {
-                "temps_min": [],
-                "temps_max": [],
-                "temps": [],
-                "humidities": [],
-                "wind_speeds": [],
-                "descriptions": [],
-            }
-        )
-
-        for item in items:
-            try:
-                dt_ts = item.get("dt")
-                if dt_ts is None:
-                    continue
-                dt_utc = datetime.utcfromtimestamp(dt_ts)
-                dt_local = dt_utc + timedelta(seconds=tz_offset)
-                date_key = dt_local.date().isoformat()
-
-                main = item.get("main") or {}
-                weather_list = item.get("weather") or []
-                wind = item.get("wind") or {}
-
-                temp = main.get("temp")
-                temp_min = main.get("temp_min")
-                temp_max = main.get("temp_max")
-                humidity = main.get("humidity")
-                descr = weather_list[0].get("description") if weather_list else None
-                wind_speed = wind.get("speed")
-
-                day = days[date_key]
-                if temp is not None:
-                    day["temps"].append(temp)
-                if temp_min is not None:
-                    day["temps_min"].append(temp_min)
-                if temp_max is not None:
-                    day["temps_max"].append(temp_max)
-                if humidity is not None:
-                    day["humidities"].append(humidity)
-                if wind_speed is not None:
-                    day["wind_speeds"].append(wind_speed)
-                if descr:
-                    day["descriptions"].append(descr)
-            except Exception:
-                # Пропускаем странные записи, не роняя всё
-                continue
-
-        # Формируем daily‑список, отсортированный по дате
-        daily_list = []
-        for date_key in sorted(days.keys()):
-            d = days[date_key]
-
-            def avg(values):
-                return sum(values) / len(values) if values else None
-
-            temp_min = min(d["temps_min"]) if d["temps_min"] else None
-            temp_max = max(d["temps_max"]) if d["temps_max"] else None
-            temp_day = avg(d["temps"])
-            humidity = avg(d["humidities"])
-            wind_speed = avg(d["wind_speeds"])
-
-            # самая частая формулировка погоды за день
-            description = None
-            if d["descriptions"]:
-                from collections import Counter
-
-                description = Counter(d["descriptions"]).most_common(1)[0][0]
-
-            daily_list.append(
-                {
-                    "date": date_key,
-                    "temp": {"min": temp_min, "max": temp_max, "day": temp_day},
-                    "humidity": humidity,
-                    "wind_speed": wind_speed,
-                    "weather": (
-                        [{"description": description}] if description else []
-                    ),
-                }
-            )
-
-        result = {"daily": daily_list}
-        save_to_cache_by_key(result, latitude, longitude, "forecast_5d")
+        result = _aggregate_daily_forecast(response.json())
+        if "error" not in result:
+            save_to_cache_by_key(result, latitude, longitude, "forecast_5d")
         return result
 
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
     except Exception as e:
         return {"error": f"Ошибка получения/обработки ежедневного прогноза: {e}"}
 
 
+@ttl_cache()
 def get_daily_forecast_by_city(city: str) -> dict:
     """Получает ежедневный прогноз погоды (до 8 дней вперёд) по названию города."""
-    coords = get_coordinates(city)
+    try:
+        coords = get_coordinates(city)
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
     if not coords:
         return {"error": "Город не найден"}
 
@@ -312,6 +537,56 @@ def get_daily_forecast_by_city(city: str) -> dict:
     return get_daily_forecast(lat, lon)
 
 
+async def aget_daily_forecast(latitude: float, longitude: float) -> dict:
+    """Асинхронная версия get_daily_forecast (тот же формат результата)."""
+    cached = load_from_cache_by_key(latitude, longitude, "forecast_5d")
+    if cached:
+        return cached
+
+    url = (
+        "https://api.openweathermap.org/data/2.5/forecast"
+        f"?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric&lang=ru"
+    )
+
+    try:
+        response = await http_client.aget_with_retries(url)
+        if not response:
+            return {"error": "Нет ответа от сервера прогноза (forecast_5d)"}
+
+        if response.status_code != 200:
+            return {
+                "error": f"Ошибка запроса ежедневного прогноза (forecast_5d): "
+                f"{response.status_code} {response.text}"
+            }
+
+        result = _aggregate_daily_forecast(msgspec.json.decode(response.content))
+        if "error" not in result:
+            save_to_cache_by_key(result, latitude, longitude, "forecast_5d")
+        return result
+
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
+    except Exception as e:
+        return {"error": f"Ошибка получения/обработки ежедневного прогноза: {e}"}
+
+
+@ttl_cache()
+async def aget_daily_forecast_by_city(city: str, coords: tuple | None = None) -> dict:
+    """Асинхронно получает ежедневный прогноз погоды по названию города.
+
+    Если координаты города уже известны (coords), геокодинг пропускается.
+    """
+    try:
+        coords = coords or await aget_coordinates(city)
+    except http_client.CircuitBreakerError:
+        return {"error": SERVICE_UNAVAILABLE}
+    if not coords:
+        return {"error": "Город не найден"}
+
+    lat, lon = coords
+    return await aget_daily_forecast(lat, lon)
+
+
 def get_air_pollution(latitude: float, longitude: float) -> dict:
     """Получает данные о загрязнении воздуха по координатам"""
     cached = load_from_cache_by_key(latitude, longitude, 'air_pollution')